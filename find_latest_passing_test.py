@@ -11,13 +11,14 @@ Given a bad build, find the latest good one
 import re
 import argparse
 from squad_client.core.models import Squad, Build
-from squad_client.core.api import SquadApi
 from squad_client.utils import first
 
+from squadutilslib import configure_squad_client
+
 
 def main(args):
     # Some configuration, might get parameterized later
-    SquadApi.configure(args.get("squadapi_url", None))
+    configure_squad_client(args.get("squadapi_url", None))
     squad = Squad()
     getid = lambda s: int(re.search(r"\d+", s).group())  # noqa
     group = squad.group(args.get("group", None))
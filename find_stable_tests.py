@@ -7,11 +7,14 @@
 
 
 import argparse
+import json
+import os
 from collections import defaultdict
 from squad_client.core.models import Squad
-from squad_client.core.api import SquadApi
 from squad_client.utils import getid, parse_test_name
 
+from squadutilslib import configure_squad_client
+
 
 do_color = False
 
@@ -44,11 +47,14 @@ def stableness(results, target="pass", pad=10):
     by the total number of results.
     """
 
-    if len(results) == 0:
+    return stableness_from_counts(results.count(target), len(results), pad=pad)
+
+
+def stableness_from_counts(pass_count, total, pad=10):
+    if total == 0:
         return -1, red("N/A".center(pad))
 
-    pass_count = results.count(target)
-    n = pass_count / len(results)
+    n = pass_count / total
     out = str(round(n * 100)) + "%"
 
     color = str
@@ -61,6 +67,127 @@ def stableness(results, target="pass", pad=10):
     return n, color(out.center(pad))
 
 
+def count_results(tests, envs={}):
+    """
+    Count the "pass" results and the total number of results of each test,
+    per environment slug if environments are given:
+
+      {"suiteA/testA": {"envA": [pass, total], "envB": [pass, total]}}
+
+    Without environments all results are counted under "".
+    """
+
+    counts = defaultdict(lambda: defaultdict(lambda: [0, 0]))
+    for test in tests:
+        env_slug = envs[getid(test.environment)].slug if len(envs) else ""
+        count = counts[test.name][env_slug]
+        if test.status == "pass":
+            count[0] += 1
+        count[1] += 1
+
+    return counts
+
+
+class FlakinessIndex:
+    """
+    Pass and total counters per test and environment over a sliding window
+    of builds, persisted to a JSON file. Each build's own counters are kept
+    so that it can be subtracted again when it leaves the window, and only
+    builds that are new since the last run need to be fetched. Only finished
+    builds are kept, unfinished ones are fetched again on every run.
+    """
+
+    # Bump when the saved data changes meaning, so existing files are rebuilt
+    VERSION = 1
+
+    def __init__(self, filename, filters):
+        self.filename = filename
+        self.filters = filters
+        self.builds = []
+        self.counts = defaultdict(lambda: defaultdict(lambda: [0, 0]))
+
+        if not os.path.exists(filename):
+            return
+
+        with open(filename) as f:
+            data = json.load(f)
+        if data.get("version") != self.VERSION:
+            print(f"I: {filename} was saved by a different version, rebuilding it")
+            return
+        if data["filters"] != filters:
+            print(f"I: Filters changed since {filename} was saved, rebuilding it")
+            return
+
+        self.builds = data["builds"]
+        for test_name, envs in data["counts"].items():
+            for env_slug, count in envs.items():
+                self.counts[test_name][env_slug] = count
+
+    def __contains__(self, build_id):
+        return build_id in [build["id"] for build in self.builds]
+
+    @staticmethod
+    def _apply(total_counts, counts, sign):
+        for test_name, envs in counts.items():
+            for env_slug, (pass_count, total) in envs.items():
+                count = total_counts[test_name][env_slug]
+                count[0] += sign * pass_count
+                count[1] += sign * total
+                if count[1] == 0:
+                    del total_counts[test_name][env_slug]
+            if not total_counts[test_name]:
+                del total_counts[test_name]
+
+    def add(self, build, counts):
+        self.builds.append({"id": build.id, "version": build.version, "counts": counts})
+        self._apply(self.counts, counts, 1)
+
+    def evict(self, build_id):
+        build = next(b for b in self.builds if b["id"] == build_id)
+        self.builds.remove(build)
+        self._apply(self.counts, build["counts"], -1)
+
+    def update(self, builds, fetch_counts):
+        """
+        Slide the window to the given builds: subtract the builds that left
+        the window and add the new ones, calling fetch_counts(build) to get
+        the counters of each new build. Unfinished builds are still receiving
+        results, so they are counted for this run without being added to the
+        index. Returns the counters for the whole window.
+        """
+        window = [build.id for build in builds]
+        for build in list(self.builds):
+            if build["id"] not in window:
+                print(f"I: Evicting build {build['version']} from the index")
+                self.evict(build["id"])
+
+        window_counts = defaultdict(lambda: defaultdict(lambda: [0, 0]))
+        for build in builds:
+            if build.id in self:
+                continue
+            counts = fetch_counts(build)
+            if build.finished:
+                self.add(build, counts)
+            else:
+                print(f"I: Build {build.version} is unfinished, not adding it to the index")
+                self._apply(window_counts, counts, 1)
+
+        self._apply(window_counts, self.counts, 1)
+        return window_counts
+
+    def save(self):
+        data = {
+            "version": self.VERSION,
+            "filters": self.filters,
+            "builds": self.builds,
+            "counts": self.counts,
+        }
+        tmp_filename = f"{self.filename}.tmp"
+        with open(tmp_filename, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_filename, self.filename)
+
+
 def find_stable_tests(tests, envs={}, suites={}):
     """
     Print a list of stable tests
@@ -75,13 +202,21 @@ def find_stable_tests(tests, envs={}, suites={}):
 
     """
 
-    if len(tests) == 0:
+    print_stable_tests(count_results(tests, envs), envs=envs)
+
+
+def print_stable_tests(counts, envs={}):
+    """
+    Print a list of stable tests from the counters returned by
+    count_results, or kept by a FlakinessIndex
+    """
+
+    if len(counts) == 0:
         print("*** No tests available ***")
         return
 
     envs_slugs = sorted([env.slug for env in envs.values()])
-    tests_names = sorted(set([test.name for test in tests]))
-    tests_dict = {}
+    tests_names = sorted(counts.keys())
 
     # Longest test name
     longest_test_name = max(
@@ -95,12 +230,6 @@ def find_stable_tests(tests, envs={}, suites={}):
         # Longest env slug
         longest_env_slug = max(10, max([len(slug) for slug in envs_slugs]))
 
-        envs_dict = {env.slug: [] for env in envs.values()}
-        tests_dict = defaultdict(lambda: envs_dict.copy())
-        for test in tests:
-            env = envs[getid(test.environment)]
-            tests_dict[test.name][env.slug].append(test.status)
-
         print(" " * (3 + longest_test_name), end="")
         envs_header = "|".join([slug.center(longest_env_slug) for slug in envs_slugs])
         print(f"|{envs_header}|")
@@ -114,17 +243,13 @@ def find_stable_tests(tests, envs={}, suites={}):
 
             print(f"- {test.ljust(longest_test_name)} ", end="")
             for env_slug in envs_slugs:
-                n, out = stableness(
-                    tests_dict[test_name][env_slug], pad=longest_env_slug
+                n, out = stableness_from_counts(
+                    *counts[test_name].get(env_slug, [0, 0]), pad=longest_env_slug
                 )
                 suites_stableness[suite_slug].append(n)
                 print(f"|{out}", end="")
             print("|")
     else:
-        tests_dict = defaultdict(list)
-        for test in tests:
-            tests_dict[test.name].append(test.status)
-
         prev_suite_slug = None
         for test_name in tests_names:
             suite_slug, test = parse_test_name(test_name)
@@ -132,7 +257,9 @@ def find_stable_tests(tests, envs={}, suites={}):
                 prev_suite_slug = suite_slug
                 print(f"\n\033[1m{prev_suite_slug}\033[0m")
 
-            n, out = stableness(tests_dict[test_name])
+            n, out = stableness_from_counts(
+                *[sum(c) for c in zip(*counts[test_name].values())]
+            )
             suites_stableness[suite_slug].append(n)
             print(f"- {test.ljust(longest_test_name)} {out}")
 
@@ -145,12 +272,30 @@ def find_stable_tests(tests, envs={}, suites={}):
         print(f"\033[1m{suite_slug.ljust(longest_suite_slug)}\033[0m: {out}")
 
 
+def fetch_build_tests(build, test_filters):
+    print(f"D: Fetching build {build.version} tests ({test_filters})", flush=True)
+    tests = []
+    num_tests = 0
+    for test in build.tests(**test_filters).values():
+        if test.name.startswith("linux-log-parser"):
+            continue
+        tests.append(test)
+        if num_tests % 1000 == 0:
+            print(".", end="", flush=True)
+        num_tests += 1
+
+    if num_tests:
+        print()
+
+    return tests
+
+
 def main(args):
     global do_color
 
     do_color = args.color
 
-    SquadApi.configure(args.squadapi_url)
+    configure_squad_client(args.squadapi_url)
     squad = Squad()
     print(f"I: Fetching group {args.group}")
     group = squad.group(args.group)
@@ -185,21 +330,32 @@ def main(args):
         print(f"I: Fetching {args.group}/{args.project} environments")
         envs = project.environments()
 
-    tests = []
     print(f"I: Fetching {args.n} builds ({build_filters}):", flush=True)
-    for build in project.builds(**build_filters).values():
-        print(f"D: Fetching build {build.version} tests ({test_filters})", flush=True)
-        num_tests = 0
-        for test in build.tests(**test_filters).values():
-            if test.name.startswith("linux-log-parser"):
-                continue
-            tests.append(test)
-            if num_tests % 1000 == 0:
-                print(".", end="", flush=True)
-            num_tests += 1
+    builds = project.builds(**build_filters).values()
+
+    if args.index:
+        index = FlakinessIndex(
+            args.index,
+            {
+                "group": args.group,
+                "project": args.project,
+                "test_filters": test_filters,
+                "no_arch": args.no_arch,
+            },
+        )
+        counts = index.update(
+            builds,
+            lambda build: count_results(fetch_build_tests(build, test_filters), envs),
+        )
+        index.save()
+
+        print("I: Finding stable tests")
+        print_stable_tests(counts, envs=envs)
+        return
 
-        if num_tests:
-            print()
+    tests = []
+    for build in builds:
+        tests += fetch_build_tests(build, test_filters)
 
     print("I: Finding stable tests")
     find_stable_tests(
@@ -252,6 +408,10 @@ if __name__ == "__main__":
         default="https://qa-reports.linaro.org",
         help="url to SQUAD server",
     )
+    parser.add_argument(
+        "--index",
+        help="JSON file to keep per-test pass/total counters for the window of builds in, so that later runs only fetch new builds",
+    )
     parser.add_argument(
         "--color",
         action="store_true",
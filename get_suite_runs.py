@@ -9,14 +9,15 @@ import re
 import argparse
 from collections import defaultdict
 from squad_client.core.models import Squad, ALL
-from squad_client.core.api import SquadApi
+
+from squadutilslib import configure_squad_client
 
 
 def main(args):
     # Some configuration, might get parameterized later
     group_slug = args.get("group", None)
     suite_slug = args.get("suite", None)
-    SquadApi.configure(args.get("squadapi_url", None))
+    configure_squad_client(args.get("squadapi_url", None))
     number_of_builds = args.get("number", None)
     squad = Squad()
     getid = lambda s: int(re.search(r"\d+", s).group())  # noqa
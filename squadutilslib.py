@@ -7,14 +7,31 @@
 # SPDX-License-Identifier: MIT
 
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from copy import deepcopy
+from gzip import open as gzip_open
+from json import dump as json_dump
+from json import load as json_load
 from logging import DEBUG, INFO, basicConfig, getLogger
-from os import path, remove
+from os import getenv, path, remove
 from pathlib import Path
-from re import findall, match, search, sub
-from time import sleep
-
-from requests import HTTPError, get
-from squad_client.core.models import Build, Squad, TestRun
+from random import uniform
+from re import compile as compile_regex
+from re import findall, finditer, match, search, sub
+from shlex import quote
+from sqlite3 import connect
+from threading import BoundedSemaphore, Event, Lock
+from time import monotonic, sleep
+from zlib import compress, decompress
+
+from requests import HTTPError, RequestException, Session, get
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError as RequestConnectionError
+from requests.exceptions import Timeout as RequestTimeout
+from squad_client.core.api import SquadApi
+from squad_client.core.models import ALL, Build, Squad, Test, TestRun
+from squad_client.settings import SQUAD_MAX_PAGE_LIMIT
 from squad_client.shortcuts import download_tests
 from squad_client.utils import first, getid
 from tuxrun.utils import slugify
@@ -23,6 +40,22 @@ from yaml import FullLoader, dump, load
 basicConfig(level=INFO)
 logger = getLogger(__name__)
 
+# Expected runtime in seconds, used when splitting TuxPlan tests between boots
+# for commands with no historical runtime
+DEFAULT_COMMAND_RUNTIME = 300
+
+DEFAULT_SQUAD_HOST = "https://qa-reports.linaro.org/"
+# Limits for the requests made to SQUAD by all the threads of a tool, these can
+# be tuned from the environment when running several tools at once
+DEFAULT_SQUAD_MAX_CONCURRENCY = int(getenv("SQUAD_MAX_CONCURRENCY", 8))
+DEFAULT_SQUAD_REQUEST_RATE = float(getenv("SQUAD_REQUEST_RATE", 20))
+DEFAULT_SQUAD_RETRIES = int(getenv("SQUAD_RETRIES", 5))
+DEFAULT_SQUAD_BACKOFF = 1
+DEFAULT_SQUAD_TIMEOUT = 120
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# Connect and read timeouts in seconds for squad-query-daemon queries
+DAEMON_TIMEOUT = (5, 120)
+
 
 class ReproducerNotFound(Exception):
     """
@@ -33,6 +66,953 @@ class ReproducerNotFound(Exception):
         super().__init__(message)
 
 
+class SquadObjectNotFound(Exception):
+    """
+    Raised when a SQUAD group, project, build, environment, suite or test
+    cannot be found.
+    """
+
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache. Entries are evicted once more than
+    maxsize entries are stored or, if ttl is set, once they are older than ttl
+    seconds.
+    """
+
+    def __init__(self, maxsize=256, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            value, stored_at = self._entries[key]
+            if self.ttl is not None and monotonic() - stored_at > self.ttl:
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_or_set(self, key, func):
+        """
+        Return the cached value for key, calling func to create it when it is
+        missing or expired. None is never cached so failed lookups are retried.
+        """
+        value = self.get(key)
+        if value is None:
+            value = func()
+            if value is not None:
+                self.set(key, value)
+        return value
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RequestGovernor:
+    """
+    Limit the SQUAD requests made by all threads to max_concurrency requests
+    in flight and, if rate is set, to rate requests started per second.
+    """
+
+    def __init__(self, max_concurrency=8, rate=None):
+        self.max_concurrency = max_concurrency
+        self.rate = rate
+        self._slots = BoundedSemaphore(max_concurrency)
+        self._lock = Lock()
+        self._next_start = monotonic()
+
+    def __enter__(self):
+        self._slots.acquire()
+        if self.rate:
+            with self._lock:
+                now = monotonic()
+                start = max(now, self._next_start)
+                self._next_start = start + 1 / self.rate
+            sleep(start - now)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._slots.release()
+
+
+class _InflightRequest:
+    def __init__(self):
+        self.done = Event()
+        self.response = None
+        self.error = None
+
+
+class SquadClient:
+    """
+    Client layer shared by all the tools for the GET requests squad_client
+    makes to SQUAD. Requests go through a pooled session and a
+    RequestGovernor, are retried with jittered exponential backoff on
+    connection errors, timeouts, 429 and 5xx responses, and identical
+    requests that are already in flight are coalesced into one.
+    """
+
+    def __init__(
+        self,
+        max_concurrency=DEFAULT_SQUAD_MAX_CONCURRENCY,
+        rate=DEFAULT_SQUAD_REQUEST_RATE,
+        retries=DEFAULT_SQUAD_RETRIES,
+        backoff=DEFAULT_SQUAD_BACKOFF,
+        timeout=DEFAULT_SQUAD_TIMEOUT,
+    ):
+        self.governor = RequestGovernor(max_concurrency, rate)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._request = SquadApi.__request__
+        self._inflight = {}
+        self._lock = Lock()
+
+    def session(self):
+        """
+        Return a session pooling enough connections for every request the
+        governor allows in flight. Retries are done by SquadClient.get so they
+        are governed and jittered, so the adapter doesn't retry by itself.
+        """
+        adapter = HTTPAdapter(
+            pool_connections=self.governor.max_concurrency,
+            pool_maxsize=self.governor.max_concurrency,
+            max_retries=0,
+        )
+        session = Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def backoff_delay(self, attempt, response=None):
+        if response is not None and response.headers.get("Retry-After", "").isdigit():
+            return int(response.headers["Retry-After"])
+        # Full jitter, so threads that failed together don't retry together
+        return uniform(0, self.backoff * 2**attempt)
+
+    def request(self, endpoint, params):
+        attempt = 0
+        while True:
+            error = response = None
+            with self.governor:
+                try:
+                    response = self._request(
+                        "GET", endpoint, params=dict(params), timeout=self.timeout
+                    )
+                except RequestException as e:
+                    # squad_client wraps every error in ApiException, only
+                    # retry the ones caused by the connection
+                    if not isinstance(
+                        e.__context__, (RequestConnectionError, RequestTimeout)
+                    ):
+                        raise
+                    error = e
+            if error is None and response.status_code not in RETRY_STATUS_CODES:
+                return response
+            if attempt >= self.retries:
+                if error is not None:
+                    raise error
+                return response
+            delay = self.backoff_delay(attempt, response)
+            logger.warning(
+                f"GET {endpoint} failed ({error or response.status_code}), retrying in {delay:.1f}s"
+            )
+            sleep(delay)
+            attempt += 1
+
+    def get(self, endpoint, params={}):
+        key = (endpoint, tuple(sorted((k, str(v)) for k, v in params.items())))
+        with self._lock:
+            inflight = self._inflight.get(key)
+            owner = inflight is None
+            if owner:
+                inflight = self._inflight[key] = _InflightRequest()
+
+        if not owner:
+            logger.debug(f"Waiting for in-flight GET {endpoint} {params}")
+            inflight.done.wait()
+            if inflight.error is not None:
+                raise inflight.error
+            return inflight.response
+
+        try:
+            inflight.response = self.request(endpoint, params)
+            return inflight.response
+        except Exception as e:
+            inflight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            inflight.done.set()
+
+
+def configure_squad_client(
+    url=None,
+    token=None,
+    cache=0,
+    max_concurrency=DEFAULT_SQUAD_MAX_CONCURRENCY,
+    rate=DEFAULT_SQUAD_REQUEST_RATE,
+    retries=DEFAULT_SQUAD_RETRIES,
+    backoff=DEFAULT_SQUAD_BACKOFF,
+    timeout=DEFAULT_SQUAD_TIMEOUT,
+):
+    """
+    Configure squad_client like SquadApi.configure, routing every GET request
+    it makes through a SquadClient. This should be used by all the tools
+    instead of SquadApi.configure. Returns the SquadClient.
+    """
+    client = SquadClient(
+        max_concurrency=max_concurrency,
+        rate=rate,
+        retries=retries,
+        backoff=backoff,
+        timeout=timeout,
+    )
+    SquadApi.session = client.session()
+    SquadApi.get = staticmethod(client.get)
+    SquadApi.configure(
+        url=url or getenv("SQUAD_HOST", DEFAULT_SQUAD_HOST), token=token, cache=cache
+    )
+    return client
+
+
+class SquadResolver:
+    """
+    Resolve SQUAD groups, projects, builds, environments and suites by slug,
+    keeping the results in an LRU cache so repeated queries against the same
+    build do not have to resolve everything again.
+    """
+
+    def __init__(self, maxsize=256, ttl=3600):
+        self.cache = LRUCache(maxsize=maxsize, ttl=ttl)
+
+    def group(self, group_slug):
+        group = self.cache.get_or_set(
+            ("group", group_slug), lambda: Squad().group(group_slug)
+        )
+        if group is None:
+            raise SquadObjectNotFound(
+                f"Get group failed. Group not found: '{group_slug}'."
+            )
+        return group
+
+    def project(self, group_slug, project_slug):
+        group = self.group(group_slug)
+        project = self.cache.get_or_set(
+            ("project", group_slug, project_slug),
+            lambda: group.project(project_slug),
+        )
+        if project is None:
+            raise SquadObjectNotFound(
+                f"Get project failed. Project not found: '{project_slug}'."
+            )
+        return project
+
+    def build(self, project, version, message="Get build failed"):
+        key = ("build", project.id, version)
+        build = self.cache.get(key)
+        if build is None:
+            build = project.build(version)
+            # Unfinished builds are still receiving results, so only keep
+            # finished builds. Don't use build.tests() on cached builds,
+            # squad_client keeps the tests it fetches on the Build object.
+            if build is not None and build.finished:
+                self.cache.set(key, build)
+        if build is None:
+            raise SquadObjectNotFound(f"{message}. Build not found: '{version}'.")
+        return build
+
+    def is_finished(self, group_slug, project_slug, version):
+        """
+        Return whether a build resolved earlier was finished. Only finished
+        builds are cached, so this doesn't query SQUAD.
+        """
+        project = self.project(group_slug, project_slug)
+        return self.cache.get(("build", project.id, version)) is not None
+
+    def environments(self, project):
+        """Return the project environments as a dict keyed by ID."""
+        environments = self.cache.get_or_set(
+            ("environments", project.id),
+            lambda: project.environments(count=ALL, ordering="slug") or None,
+        )
+        if environments is None:
+            raise SquadObjectNotFound("Get environments failed. No environments found.")
+        return environments
+
+    def suites(self, project):
+        """Return the project suites as a dict keyed by ID."""
+        suites = self.cache.get_or_set(
+            ("suites", project.id),
+            lambda: project.suites(count=ALL, ordering="slug") or None,
+        )
+        if suites is None:
+            raise SquadObjectNotFound("Get suites failed. No suites found.")
+        return suites
+
+    def _by_id(self, kind, project, object_id):
+        objects = getattr(self, kind)(project)
+        if object_id not in objects:
+            # SQUAD creates environments and suites as results arrive, so
+            # refresh the cached ones once before giving up
+            self.cache.delete((kind, project.id))
+            objects = getattr(self, kind)(project)
+        if object_id not in objects:
+            raise SquadObjectNotFound(
+                f"Get {kind} failed. ID not found: '{object_id}'."
+            )
+        return objects[object_id]
+
+    def environment_by_id(self, project, environment_id):
+        return self._by_id("environments", project, environment_id)
+
+    def suite_by_id(self, project, suite_id):
+        return self._by_id("suites", project, suite_id)
+
+    def environment(self, project, environment_slug):
+        environment = self.cache.get_or_set(
+            ("environment", project.id, environment_slug),
+            lambda: project.environment(environment_slug),
+        )
+        if environment is None:
+            raise SquadObjectNotFound(
+                f"Get environment failed. Environment not found: '{environment_slug}'."
+            )
+        return environment
+
+    def suite(self, project, suite_slug):
+        suite = self.cache.get_or_set(
+            ("suite", project.id, suite_slug), lambda: project.suite(suite_slug)
+        )
+        if suite is None:
+            raise SquadObjectNotFound(
+                f"Get suite failed. Suite not found: '{suite_slug}'."
+            )
+        return suite
+
+
+def iterate_objects(klass, endpoint=None, page_size=SQUAD_MAX_PAGE_LIMIT, **filters):
+    """
+    Lazily iterate over objects from the API, fetching one page at a time.
+    Unlike the squad_client fetch methods with count=ALL, only the current
+    page is held in memory.
+    """
+    filters["limit"] = page_size
+    url = endpoint or klass.endpoint
+    while url:
+        result = SquadApi.get(url, filters).json()
+        yield from klass().__fill__(klass, result["results"]).values()
+        url = result["next"]
+        # The next page URL already carries the filters
+        filters = {}
+
+
+def iterate_tests(build, page_size=SQUAD_MAX_PAGE_LIMIT, **filters):
+    """Lazily iterate over the tests of a build, one page at a time."""
+    return iterate_objects(
+        Test, f"{Build.endpoint}{build.id}/tests/", page_size, **filters
+    )
+
+
+def iterate_build_results(resolver, group_slug, project_slug, build_version, **filters):
+    """
+    Yield the results for a build as flat dicts, optionally filtered with the
+    filters accepted by the SQUAD tests API. The tests are fetched one page at
+    a time as the results are consumed, and aren't kept on the Build object,
+    so the builds cached by the resolver don't hold on to their tests.
+    """
+    project = resolver.project(group_slug, project_slug)
+    build = resolver.build(project, build_version)
+
+    # https://qa-reports.linaro.org/api/tests/
+    tests = iterate_tests(build, **filters)
+
+    found = False
+    for test in tests:
+        found = True
+        yield {
+            "group": group_slug,
+            "project": project.slug,
+            "build": build.version,
+            "environment": resolver.environment_by_id(
+                project, getid(test.environment)
+            ).slug,
+            "suite": resolver.suite_by_id(project, getid(test.suite)).slug,
+            "test": test.short_name,
+            "status": test.status,
+            "has_known_issues": test.has_known_issues,
+        }
+
+    if not found:
+        raise SquadObjectNotFound("Get tests failed. No tests found.")
+
+
+def list_build_results(resolver, group_slug, project_slug, build_version, **filters):
+    """
+    Return a flat list of the results for a build, optionally filtered with
+    the filters accepted by the SQUAD tests API.
+    """
+    return list(
+        iterate_build_results(
+            resolver, group_slug, project_slug, build_version, **filters
+        )
+    )
+
+
+def get_test_details(
+    resolver,
+    group_slug,
+    project_slug,
+    build_version,
+    environment_slug,
+    suite_slug,
+    test_name,
+):
+    """
+    Return all of the data about a test, including the metadata of the
+    TestRun it belongs to.
+    """
+    project = resolver.project(group_slug, project_slug)
+    build = resolver.build(project, build_version)
+    environment = resolver.environment(project, environment_slug)
+    suite = resolver.suite(project, suite_slug)
+
+    test = first(
+        Squad().tests(
+            build=build.id,
+            environment=environment.id,
+            suite=suite.id,
+            metadata__name=test_name,
+            count=1,
+        )
+    )
+    if not test:
+        raise SquadObjectNotFound(f"Get test failed. Test not found: '{test_name}'.")
+
+    test_run = TestRun(getid(test.test_run))
+
+    flat = dict(test.__dict__)
+    flat.update(
+        {
+            "group": group_slug,
+            "project": project.slug,
+            "environment": environment.slug,
+            "suite": suite.slug,
+            "build": build.version,
+            "metadata": test_run.metadata,
+        }
+    )
+    flat.pop("test_run")
+    return flat
+
+
+def list_build_changes(
+    resolver, group_slug, project_slug, build_version, base_build_version
+):
+    """
+    Return a flat list of the regressions and fixes in a build when compared
+    to a base build.
+    """
+    project = resolver.project(group_slug, project_slug)
+    build = resolver.build(project, build_version)
+    base_build = resolver.build(
+        project, base_build_version, message="Get base build failed"
+    )
+
+    changes = project.compare_builds(base_build.id, build.id, force=True)
+    return flatten_changes(group_slug, project, base_build, build, changes)
+
+
+def fetch_build_logs(
+    resolver,
+    group_slug,
+    project_slug,
+    build_version,
+    environment_slug=None,
+    suite_slug=None,
+    jobs=8,
+):
+    """
+    Yield the tests with a log in each TestRun of a build, as lists of flat
+    dicts including the log. The tests of each TestRun are fetched
+    concurrently with up to jobs requests in flight.
+    """
+    project = resolver.project(group_slug, project_slug)
+    build = resolver.build(project, build_version)
+
+    testrun_filters = {}
+    if environment_slug:
+        testrun_filters["environment"] = resolver.environment(
+            project, environment_slug
+        ).id
+    test_filters = {"fields": "id,short_name,status,log,suite,environment"}
+    if suite_slug:
+        test_filters["suite"] = resolver.suite(project, suite_slug).id
+
+    def fetch_testrun_logs(testrun):
+        return [
+            {
+                "id": test.id,
+                "group": group_slug,
+                "project": project.slug,
+                "build": build.version,
+                "environment": resolver.environment_by_id(
+                    project, getid(test.environment)
+                ).slug,
+                "suite": resolver.suite_by_id(project, getid(test.suite)).slug,
+                "test": test.short_name,
+                "status": test.status,
+                "log": test.log,
+            }
+            for test in iterate_objects(Test, test_run=testrun.id, **test_filters)
+            if test.log
+        ]
+
+    testruns = build.testruns(count=ALL, **testrun_filters).values()
+    logger.debug(f"Fetching logs from {len(testruns)} testruns")
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(fetch_testrun_logs, testrun) for testrun in testruns]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def regex_fts_query(regex, find_terms=None):
+    """
+    Return an FTS5 query matching every log that the regular expression can
+    match, built from the words it requires literally, or None if it doesn't
+    require any. A required word may only be part of a longer word in the log:
+    words that may be the start of one are looked up as prefixes, and for the
+    others find_terms, if given, is called with a LIKE pattern and returns a
+    query for the matching indexed terms (or None to not look the word up).
+    """
+    # The regex parser is private and was moved in Python 3.11, where the old
+    # modules are deprecated
+    try:
+        from re import _constants as regex_constants
+        from re import _parser as regex_parser
+    except ImportError:
+        import sre_constants as regex_constants
+        import sre_parse as regex_parser
+
+    return _required_words_query(regex_parser.parse(regex), find_terms, regex_constants)
+
+
+def _required_words_query(items, find_terms, regex_constants):
+    terms = []
+    literal = ""
+    bounded = False
+
+    def add_literal_terms():
+        for word in finditer(r"[^\W_]+", literal):
+            starts = word.start() > 0 or bounded
+            ends = word.end() < len(literal)
+            if starts:
+                terms.append(f'"{word.group()}"' + ("" if ends else "*"))
+            elif find_terms and word.group().isascii():
+                term = find_terms("%" + word.group().lower() + ("" if ends else "%"))
+                if term:
+                    terms.append(term)
+
+    for op, value in items:
+        if op == regex_constants.LITERAL:
+            literal += chr(value)
+            continue
+
+        add_literal_terms()
+        literal = ""
+        # The start of a word is known after an anchor or word boundary
+        bounded = op == regex_constants.AT and value != regex_constants.AT_NON_BOUNDARY
+
+        subquery = None
+        if op == regex_constants.SUBPATTERN:
+            subquery = _required_words_query(value[-1], find_terms, regex_constants)
+        elif op in (regex_constants.MAX_REPEAT, regex_constants.MIN_REPEAT):
+            if value[0] > 0:
+                subquery = _required_words_query(value[-1], find_terms, regex_constants)
+        elif op == regex_constants.BRANCH:
+            subqueries = [
+                _required_words_query(branch, find_terms, regex_constants)
+                for branch in value[1]
+            ]
+            if all(subqueries):
+                subquery = "(" + " OR ".join(subqueries) + ")"
+        if subquery:
+            terms.append(subquery)
+    add_literal_terms()
+
+    return " AND ".join(terms) or None
+
+
+class TestLogIndex:
+    """
+    Local SQLite index of test logs. Logs are stored zlib-compressed
+    alongside a contentless FTS5 table, so the full-text index is kept
+    without storing a second uncompressed copy of every log.
+    """
+
+    # "group" is a reserved word in SQL
+    FIELDS = {
+        "group": "grp",
+        "project": "project",
+        "build": "build",
+        "environment": "environment",
+        "suite": "suite",
+        "test": "test",
+        "status": "status",
+    }
+
+    def __init__(self, filename="squad_testlogs.sqlite"):
+        self.connection = connect(filename)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS logs (
+                id INTEGER PRIMARY KEY,
+                grp TEXT,
+                project TEXT,
+                build TEXT,
+                environment TEXT,
+                suite TEXT,
+                test TEXT,
+                status TEXT,
+                log BLOB
+            );
+            CREATE INDEX IF NOT EXISTS logs_build
+                ON logs (grp, project, build);
+            CREATE VIRTUAL TABLE IF NOT EXISTS logs_fts
+                USING fts5(log, content='');
+            CREATE VIRTUAL TABLE IF NOT EXISTS logs_vocab
+                USING fts5vocab(logs_fts, 'row');
+            """)
+
+    def add(self, test):
+        """
+        Add a test log, as listed by fetch_build_logs, to the index. Returns
+        False if the test was already indexed.
+        """
+        cursor = self.connection.execute(
+            "INSERT OR IGNORE INTO logs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                test["id"],
+                test["group"],
+                test["project"],
+                test["build"],
+                test["environment"],
+                test["suite"],
+                test["test"],
+                test["status"],
+                compress(test["log"].encode("utf-8")),
+            ),
+        )
+        if not cursor.rowcount:
+            return False
+        self.connection.execute(
+            "INSERT INTO logs_fts (rowid, log) VALUES (?, ?)",
+            (test["id"], test["log"]),
+        )
+        return True
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def find_terms(self, pattern, limit=1000):
+        """
+        Return an FTS5 query matching any indexed term LIKE pattern, or None
+        if there are more than limit of them.
+        """
+        terms = [
+            row[0]
+            for row in self.connection.execute(
+                "SELECT term FROM logs_vocab WHERE term LIKE ? LIMIT ?",
+                (pattern, limit + 1),
+            )
+        ]
+        if len(terms) > limit:
+            return None
+        if not terms:
+            # Nothing in the index contains the word, so match nothing
+            return f'"{pattern.strip("%")}"'
+        return "(" + " OR ".join(f'"{term}"' for term in terms) + ")"
+
+    def search(self, query=None, regex=None, **filters):
+        """
+        Yield (test, lines) for each indexed log matching the FTS5 query and
+        the regular expression, where lines are the log lines matching the
+        regular expression (or the whole log if no regex is given). filters
+        restrict the search to the given group, project, build, environment,
+        suite or test. The words a regular expression requires are looked up
+        in the full-text index first, so only the logs containing them are
+        decompressed and scanned.
+        """
+        if regex:
+            regex_query = regex_fts_query(regex, self.find_terms)
+            if regex_query and query:
+                query = f"({query}) AND {regex_query}"
+            elif regex_query:
+                query = regex_query
+            elif not query:
+                logger.warning(
+                    f"No words to look up in the index for '{regex}', scanning every log"
+                )
+
+        columns = ", ".join(f"logs.{column}" for column in self.FIELDS.values())
+        sql = f"SELECT {columns}, logs.log FROM logs"
+        conditions = []
+        params = []
+        if query:
+            sql += " JOIN logs_fts ON logs_fts.rowid = logs.id"
+            conditions.append("logs_fts MATCH ?")
+            params.append(query)
+        for field, value in filters.items():
+            if value is None:
+                continue
+            if field not in self.FIELDS:
+                raise ValueError(f"Cannot filter logs by {field}")
+            conditions.append(f"logs.{self.FIELDS[field]} = ?")
+            params.append(value)
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+
+        pattern = compile_regex(regex) if regex else None
+        for row in self.connection.execute(sql, params):
+            lines = decompress(row[-1]).decode("utf-8").splitlines()
+            if pattern:
+                lines = [line for line in lines if pattern.search(line)]
+                if not lines:
+                    continue
+            yield dict(zip(self.FIELDS, row[:-1])), lines
+
+
+# When a test has several results in a build, the first status in this list
+# wins
+STATUS_PRECEDENCE = ["fail", "xfail", "skip", "pass"]
+
+
+def status_rank(status):
+    if status in STATUS_PRECEDENCE:
+        return STATUS_PRECEDENCE.index(status)
+    return len(STATUS_PRECEDENCE)
+
+
+class BuildResultStore:
+    """
+    Keep the results of builds, and the regressions and fixes between pairs
+    of builds, as compressed JSON files in cache_dir so each build only has
+    to be fetched, and each pair of builds compared, once. Unfinished builds
+    can still change, so their results and changes are never stored.
+    """
+
+    def __init__(self, resolver, cache_dir="squad_build_cache"):
+        self.resolver = resolver
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(exist_ok=True, parents=True)
+
+    def _load(self, filename):
+        cache_file = self.cache_dir / filename
+        if not cache_file.exists():
+            return None
+        with gzip_open(cache_file, "rt", encoding="utf-8") as f:
+            return json_load(f)
+
+    def _store(self, filename, data):
+        cache_file = self.cache_dir / filename
+        tmp_file = cache_file.with_suffix(".tmp")
+        with gzip_open(tmp_file, "wt", encoding="utf-8") as f:
+            json_dump(data, f)
+        tmp_file.replace(cache_file)
+
+    def results(self, group_slug, project, build):
+        """
+        Return the results of a build as a nested dict of
+        {environment: {suite: {test: status}}}.
+        """
+        filename = f"results-{build.id}.json.gz"
+        results = self._load(filename)
+        if results is not None:
+            return results
+
+        logger.debug(f"Fetching results for build {build.version}")
+        results = {}
+        try:
+            for result in iterate_build_results(
+                self.resolver, group_slug, project.slug, build.version
+            ):
+                tests = results.setdefault(result["environment"], {}).setdefault(
+                    result["suite"], {}
+                )
+                status = tests.get(result["test"])
+                if status is None or status_rank(result["status"]) < status_rank(
+                    status
+                ):
+                    tests[result["test"]] = result["status"]
+        except SquadObjectNotFound:
+            logger.debug(f"No tests found for build {build.version}")
+
+        if build.finished:
+            self._store(filename, results)
+        return results
+
+    def changes(self, group_slug, project, base_build, build):
+        """
+        Return the regressions (pass to fail) and fixes (fail or xfail to
+        pass) in a build compared to a base build, in the same
+        {environment: {suite: [tests]}} layout used by SQUAD's compare_builds.
+        """
+        filename = f"changes-{base_build.id}-{build.id}.json.gz"
+        changes = self._load(filename)
+        if changes is not None:
+            return changes
+
+        base_results = self.results(group_slug, project, base_build)
+        results = self.results(group_slug, project, build)
+
+        changes = {"regressions": {}, "fixes": {}}
+        for environment, suites in results.items():
+            for suite, tests in suites.items():
+                base_tests = base_results.get(environment, {}).get(suite, {})
+                for test, status in tests.items():
+                    base_status = base_tests.get(test)
+                    if base_status == "pass" and status == "fail":
+                        key = "regressions"
+                    elif base_status in ("fail", "xfail") and status == "pass":
+                        key = "fixes"
+                    else:
+                        continue
+                    changes[key].setdefault(environment, {}).setdefault(
+                        suite, []
+                    ).append(test)
+
+        if base_build.finished and build.finished:
+            self._store(filename, changes)
+        return changes
+
+
+def flatten_changes(group_slug, project, base_build, build, changes):
+    """
+    Flatten the output of compare_builds, or BuildResultStore.changes, into
+    one dict per changed test.
+    """
+    flat = []
+    for change, key in (("regression", "regressions"), ("fix", "fixes")):
+        if not changes[key]:
+            logger.debug(f"No {key} found.")
+        for environment, suites in changes[key].items():
+            for suite, tests in suites.items():
+                for test in tests:
+                    flat.append(
+                        {
+                            "group": group_slug,
+                            "project": project.slug,
+                            "build": build.version,
+                            "base_build": base_build.version,
+                            "environment": environment,
+                            "suite": suite,
+                            "test": test,
+                            "change": change,
+                        }
+                    )
+    return flat
+
+
+def list_build_range_changes(
+    resolver, store, group_slug, project_slug, build_version, count
+):
+    """
+    Return a flat list of the regressions and fixes in each of the last count
+    builds up to and including build_version, each compared to the build
+    before it. The changes are computed locally by the BuildResultStore.
+    """
+    project = resolver.project(group_slug, project_slug)
+    build = resolver.build(project, build_version)
+
+    builds = list(
+        project.builds(id__lte=build.id, ordering="-id", count=count + 1).values()
+    )
+    builds.reverse()
+    if len(builds) < 2:
+        raise SquadObjectNotFound(
+            f"Get builds failed. No builds found before: '{build_version}'."
+        )
+
+    flat = []
+    for base_build, build in zip(builds, builds[1:]):
+        changes = store.changes(group_slug, project, base_build, build)
+        flat += flatten_changes(group_slug, project, base_build, build, changes)
+    return flat
+
+
+def add_daemon_argument(parser):
+    parser.add_argument(
+        "--daemon",
+        default=getenv("SQUAD_QUERY_DAEMON"),
+        help="squad-query-daemon URL to send the query to, e.g. http://127.0.0.1:8765",
+    )
+
+
+def answer_query(daemon_url, query, fallback, **params):
+    """
+    Answer a squad-list-* query with a squad-query-daemon if daemon_url is
+    set, otherwise or if the daemon cannot answer, return fallback(), which
+    queries SQUAD directly. SQUAD is only contacted on the fallback path.
+    """
+    if daemon_url:
+        answer = query_daemon(daemon_url, query, **params)
+        if answer is not None:
+            return answer
+    return fallback()
+
+
+def query_daemon(daemon_url, query, timeout=DAEMON_TIMEOUT, **params):
+    """
+    Ask a running squad-query-daemon to answer a query. Returns the decoded
+    JSON answer, or None if the daemon could not be reached, timed out or
+    failed to answer so the caller can fall back to querying SQUAD directly.
+    SquadObjectNotFound is raised if the daemon reports that part of the
+    query could not be found.
+    """
+    url = f"{daemon_url.rstrip('/')}/{query}"
+    try:
+        # Session was imported before requests_cache could patch it, so the
+        # daemon's answers are never cached on disk
+        with Session() as session:
+            response = session.get(url, params=params, timeout=timeout)
+    except RequestException as e:
+        logger.warning(f"Query daemon not reachable at {daemon_url}: {e}")
+        return None
+
+    if response.status_code == 404:
+        raise SquadObjectNotFound(response.json()["error"])
+    if response.status_code >= 500:
+        logger.warning(
+            f"Query daemon at {daemon_url} failed to answer: {response.status_code}"
+        )
+        return None
+    response.raise_for_status()
+    return response.json()
+
+
 def get_file(path, filename=None):
     """
     Download file if a URL is passed in, then return the filename of the
@@ -251,6 +1231,65 @@ def generate_command_name_from_list(name_list):
     return command_name
 
 
+class ReproducerTemplate:
+    """
+    A TuxRun or TuxSuite reproducer parsed once into the command that boots
+    the device, with the options of the original suite removed. Variants that
+    run custom commands can then be rendered from it as shell lines or TuxPlan
+    entries without parsing the reproducer again.
+    """
+
+    def __init__(self, reproducer, suite, local=False):
+        self.local = local
+        self.command_lines = []
+        for line in reproducer.split("\n"):
+            if ("tuxsuite test submit" in line and not local) or (
+                "tuxrun --runtime" in line and local
+            ):
+                line = sub(r"--tests \S+ ", "", line)
+                line = sub(r"--parameters SHARD_INDEX=\S+ ", "", line)
+                line = sub(r"--parameters SHARD_NUMBER=\S+ ", "", line)
+                line = sub(r"--parameters SKIPFILE=\S+ ", "", line)
+                line = sub(f"{suite}=\\S+", "commands=5", line)
+                self.command_lines.append(line.strip())
+
+        self.tuxplan_entries = []
+        if not local:
+            self.tuxplan_entries = [
+                tuxtest_to_tuxplan_entry(line) for line in self.command_lines
+            ]
+
+    def render(self, custom_commands, command_name=None):
+        """Return the reproducer command line running custom_commands."""
+        if not command_name:
+            command_name = custom_commands
+
+        if self.local:
+            suffix = f" --save-outputs --log-file - -- '{custom_commands}'"
+        else:
+            suffix = f''' --parameters command-name={command_name} --commands "'{custom_commands}'"'''
+
+        return "".join(line + suffix for line in self.command_lines).strip()
+
+    def render_tuxplan_entries(self, custom_commands, command_name=None):
+        """
+        Return the TuxPlan test entries running custom_commands, the same as
+        passing the rendered command line to tuxtest_to_tuxplan_entry.
+        """
+        if self.local:
+            raise ValueError("TuxRun reproducers cannot be rendered as TuxPlans")
+        if not command_name:
+            command_name = custom_commands
+
+        entries = []
+        for base_entry in self.tuxplan_entries:
+            entry = deepcopy(base_entry)
+            entry.setdefault("parameters", {})["command-name"] = command_name
+            entry["commands"] = [sub(r"""['"]+""", r"", custom_commands)]
+            entries.append(entry)
+        return entries
+
+
 def create_custom_reproducer(
     reproducer, suite, custom_commands, filename, local=False, command_name=None
 ):
@@ -258,36 +1297,14 @@ def create_custom_reproducer(
     Given an existing TuxRun or TuxTest reproducer, edit this reproducer to run
     a given custom command.
     """
-    build_cmdline = ""
-
-    if not command_name:
-        command_name = custom_commands
-
-    for line in reproducer.split("\n"):
-        if ("tuxsuite test submit" in line and not local) or (
-            "tuxrun --runtime" in line and local
-        ):
-            line = sub(r"--tests \S+ ", "", line)
-            line = sub(r"--parameters SHARD_INDEX=\S+ ", "", line)
-            line = sub(r"--parameters SHARD_NUMBER=\S+ ", "", line)
-            line = sub(r"--parameters SKIPFILE=\S+ ", "", line)
-            line = sub(f"{suite}=\\S+", "commands=5", line)
-            if local:
-                build_cmdline = path.join(
-                    build_cmdline + line.strip() + ' --save-outputs --log-file -"'
-                ).strip()
-                build_cmdline = build_cmdline.replace('-"', f"- -- '{custom_commands}'")
-            else:
-                build_cmdline = path.join(
-                    build_cmdline
-                    + line.strip()
-                    + f''' --parameters command-name={command_name} --commands "'{custom_commands}'"'''
-                ).strip()
+    build_cmdline = ReproducerTemplate(reproducer, suite, local).render(
+        custom_commands, command_name
+    )
 
     reproducer_list = f"""#!/bin/bash\n{build_cmdline}"""
     Path(filename).write_text(reproducer_list, encoding="utf-8")
 
-    return Path(filename).read_text(encoding="utf-8")
+    return reproducer_list
 
 
 def create_ltp_custom_command(tests):
@@ -335,7 +1352,101 @@ def tuxtest_to_tuxplan_entry(tuxsuite_test):
     return dict_entry
 
 
-def create_tuxsuite_plan_from_tuxsuite_tests(tuxtest_filename, plan_name):
+def tuxplan_entry_command_name(entry):
+    return entry.get("parameters", {}).get("command-name", "command")
+
+
+def tuxplan_entry_setup(entry):
+    """
+    Return a key identifying everything a TuxPlan test entry boots (kernel,
+    device, rootfs, modules, overlays and so on), ignoring the command it runs.
+    """
+    setup = deepcopy(entry)
+    setup.pop("commands", None)
+    setup.get("parameters", {}).pop("command-name", None)
+    setup.get("timeouts", {}).pop("commands", None)
+    return dump(setup, sort_keys=True)
+
+
+def group_tuxplan_entries(entries, boots=1, runtimes=None):
+    """
+    Group TuxPlan test entries that share the same setup so each group can be
+    run in a single boot. The entries of each setup are split into at most
+    boots boots with balanced expected runtimes, using the
+    longest-processing-time-first heuristic. runtimes maps command names to
+    their historical runtime in seconds. A boot never runs the same command
+    twice, so repeated entries (for example from --run-count) get more boots
+    if needed.
+    """
+    if boots < 1:
+        raise ValueError(f"The number of boots must be at least 1, not {boots}.")
+    runtimes = runtimes or {}
+
+    def expected_runtime(entry):
+        return runtimes.get(tuxplan_entry_command_name(entry), DEFAULT_COMMAND_RUNTIME)
+
+    setups = {}
+    for entry in entries:
+        setups.setdefault(tuxplan_entry_setup(entry), []).append(entry)
+
+    groups = []
+    for setup_entries in setups.values():
+        setup_groups = [[] for _ in range(boots)]
+        totals = [0] * boots
+        for entry in sorted(setup_entries, key=expected_runtime, reverse=True):
+            command_name = tuxplan_entry_command_name(entry)
+            candidates = [
+                index
+                for index, group in enumerate(setup_groups)
+                if command_name not in [tuxplan_entry_command_name(e) for e in group]
+            ]
+            if not candidates:
+                setup_groups.append([])
+                totals.append(0)
+                candidates = [len(setup_groups) - 1]
+            index = min(candidates, key=lambda index: totals[index])
+            setup_groups[index].append(entry)
+            totals[index] += expected_runtime(entry)
+        groups += [group for group in setup_groups if group]
+
+    return groups
+
+
+def merge_tuxplan_entries(group):
+    """
+    Merge TuxPlan test entries that share the same setup into one entry. Each
+    command is wrapped in its own lava-test-case so it is still reported as a
+    separate result named after its command-name.
+    """
+    if len(group) == 1:
+        return group[0]
+
+    merged = deepcopy(group[0])
+    merged.setdefault("parameters", {})["command-name"] = "merged-commands"
+    merged["commands"] = [
+        "; ".join(
+            f"lava-test-case {tuxplan_entry_command_name(entry)} --shell {quote(command)}"
+            for entry in group
+            for command in entry["commands"]
+        )
+    ]
+    if "commands" in merged.get("timeouts", {}):
+        merged["timeouts"]["commands"] = sum(
+            entry["timeouts"].get("commands", 0) for entry in group
+        )
+
+    return merged
+
+
+def create_tuxsuite_plan_from_tuxsuite_tests(
+    tuxtest_filename, plan_name, merge=True, boots=1, runtimes=None
+):
+    """
+    Create a TuxPlan from a file of TuxSuite test commands. When merge is set,
+    commands that share a kernel/device/rootfs setup are run in the same boot,
+    split between up to boots boots per setup balanced with the runtimes of
+    previous runs.
+    """
     tuxtest_list = open(tuxtest_filename).read().splitlines()
     tuxplan_entries = []
     for tuxtest in tuxtest_list:
@@ -344,15 +1455,38 @@ def create_tuxsuite_plan_from_tuxsuite_tests(tuxtest_filename, plan_name):
             entry = tuxtest_to_tuxplan_entry(tuxtest)
             tuxplan_entries.append(entry)
 
+    return create_tuxsuite_plan(
+        tuxplan_entries, plan_name, merge=merge, boots=boots, runtimes=runtimes
+    )
+
+
+def create_tuxsuite_plan(
+    tuxplan_entries, plan_name, merge=True, boots=1, runtimes=None
+):
+    """
+    Write a TuxPlan running the given TuxPlan test entries to plan_name and
+    return its text. See create_tuxsuite_plan_from_tuxsuite_tests for merge,
+    boots and runtimes.
+    """
+    if merge:
+        groups = group_tuxplan_entries(tuxplan_entries, boots, runtimes)
+    else:
+        groups = [[entry] for entry in tuxplan_entries]
+
     test_yaml_str = f"""
 version: 1
 name: {plan_name}
 description: Run tests from customised reproducers.
-jobs:
-- name: test-command
+jobs: []
 """
     plan = load(test_yaml_str, Loader=FullLoader)
-    plan["jobs"][0]["tests"] = tuxplan_entries
+    # The tests of a plan all run in parallel, so a single job is enough
+    plan["jobs"].append(
+        {
+            "name": "test-command",
+            "tests": [merge_tuxplan_entries(group) for group in groups],
+        }
+    )
 
     plan_txt = dump(plan, sort_keys=False, default_flow_style=False)
 